@@ -8,12 +8,12 @@
 
 """
 RDPGuard - RDP 爆破检测与自动封禁工具
-- 读取火绒 log.db 的“快照副本”（避免数据库被占用导致读取失败）
+- 以只读方式直连火绒 log.db 增量读取新增记录（库被占用/锁定时改读一致的“快照副本”）
 - 提取 RDP 爆破（fname=rlogin, detail.detail.detection=RDP）
 - 将事件/统计/封禁记录持久化到 state.db
 - 自动通过 Windows 防火墙封禁
   * 永久封禁：使用“一个聚合规则”合并大量 IP（性能更好；过大自动拆分 -1/-2/...）
-  * 临时封禁：按 IP 单独规则（到期自动解封）
+  * 临时封禁：合并到一个临时聚合规则（到期自动从规则中移除）
 - 采集 Windows 防火墙 DROP 日志（pfirewall.log），用于验证封禁后仍在尝试的攻击源
 - 生成 report.html（若安装 matplotlib 可额外生成图表）
 - 导出 CSV：
@@ -28,15 +28,32 @@ RDPGuard - RDP 爆破检测与自动封禁工具
 import os
 import re
 import sys
+import atexit
 import time
+import calendar
 import json
+import functools
 import csv
+import mmap
+import hashlib
+import ipaddress
 import shutil
+import socket
 import sqlite3
 import subprocess
 from pathlib import Path
 from datetime import datetime
 
+try:
+    import re2  # 可选：google-re2，编译为 DFA，线性时间匹配、无回溯
+except ImportError:
+    re2 = None
+
+try:
+    import orjson  # 可选：C 实现的 JSON 解析，直接接受 bytes
+except ImportError:
+    orjson = None
+
 # =========================
 # 配置（按需修改）
 # =========================
@@ -65,8 +82,14 @@ CSV_BANS_200 = BASE / "bans_recent_200.csv"
 SNAPSHOT_KEEP_MAX = 50  # 每 5 分钟跑一次，保留 50~100 很够用
 
 # 防火墙规则命名
-RULE_PREFIX_TEMP = "RDPGuard"  # 临时封禁（单 IP 规则）：DisplayName="RDPGuard <ip>"
+RULE_PREFIX_TEMP = "RDPGuard"  # 旧版临时封禁（单 IP 规则）：DisplayName="RDPGuard <ip>"，仅用于到期清理
 RULE_POOL_NAME = "RDPGuard-Blocked-IP-Pool"  # 永久封禁（聚合规则）：DisplayName=该名字（必要时拆分 -1/-2/...）
+RULE_TEMP_POOL_NAME = "RDPGuard-Temp-Pool"  # 临时封禁（聚合规则）：当前未到期的临时封禁 IP（必要时拆分 -1/-2/...）
+RULE_PROBE_NAME = "RDPGuard-Probe"  # 探测单规则可容纳 IP 数时使用的临时规则（探测完即删除）
+POOL_CHUNK_MIN = 500   # 聚合规则单条 IP 数下限（保守值，探测失败时使用）
+POOL_CHUNK_MAX = 5000  # 探测上限
+POOL_PROBE_ENTRY_LEN = 18  # 探测用条目长度（IPv4 CIDR 最长形态，如 "240.100.100.100/31"）
+FW_RULES_VERIFY_SECONDS = 3600  # 核对聚合规则是否被外部删除的间隔（需列出全部规则，PowerShell 较慢，不必每轮做）
 
 # 事件保留：state.db 中 events/drops 只保留最近 N 天（用于窗口统计/报表）
 EVENT_RETENTION_DAYS = 30
@@ -93,10 +116,30 @@ RDP_PORT = 3389  # 你的 RDP 端口（默认 3389；如果你改了端口，这
 # 报表列表展示 Top N
 TOP_N = 100
 
-# IP 提取正则
-RE_IP = re.compile(
-    r"\b(?:(?:25[0-5]|2[0-4]\d|[01]?\d?\d)\.){3}"
-    r"(?:25[0-5]|2[0-4]\d|[01]?\d?\d)\b"
+# IP 提取正则：只在 detail 兜底扫描时使用，由 re_ip() 在首次用到时编译
+# （装了 google-re2 就用 re2：DFA 匹配、线性时间无回溯；否则回退标准库 re）
+# 字节串模式：直接扫描 bytes 形式的 detail，无需先解码成 str
+RE_IP_PATTERN = (
+    rb"\b(?:(?:25[0-5]|2[0-4]\d|[01]?\d?\d)\.){3}"
+    rb"(?:25[0-5]|2[0-4]\d|[01]?\d?\d)\b"
+)
+
+# detail 对象的定向定位：只认“扁平”的 detail 对象（内部至多嵌一层扁平的 rdata 对象），
+# 分组 1/3 为 detail 自身的字段，分组 2 为 rdata 的字段；结构更复杂的记录不匹配，交给 JSON 解析
+RE_DETAIL_OBJ = (re2 or re).compile(
+    rb'"detail"\s*:\s*\{([^{}]*)(?:"rdata"\s*:\s*\{([^{}]*)\}([^{}]*))?\}'
+)
+# 在上面截出的字段片段内定向提取 raddr（字符串或字符串数组），避免为整段 JSON 建树
+RE_RADDR = (re2 or re).compile(rb'"raddr"\s*:\s*(?:"([^"]*)"|\[([^\]]*)\])')
+RE_JSON_STR = (re2 or re).compile(rb'"([^"]*)"')
+# 定向提取的前提：detail 自身的 detection 字段值恰好是 "RDP"（字节标记只是预筛，也会命中 "RDPxxx"）
+RE_DETECTION_RDP = (re2 or re).compile(rb'"detection"\s*:\s*"RDP"')
+
+# detail 中 RDP 检测的字节标记（紧凑 JSON / 带空格 JSON / 单引号）
+RDP_DETAIL_MARKERS = (
+    b'detection":"RDP',
+    b'"detection": "RDP"',
+    b"'detection':'RDP'",
 )
 
 # =========================
@@ -111,28 +154,73 @@ def ts_to_local_str(ts: int) -> str:
     """时间戳转本地时间字符串"""
     return datetime.fromtimestamp(int(ts)).strftime("%Y-%m-%d %H:%M:%S")
 
+def is_ipv4(s: str) -> bool:
+    """校验点分十进制 IPv4（inet_pton 为 C 实现，不走正则引擎）"""
+    try:
+        socket.inet_pton(socket.AF_INET, s)
+    except (OSError, ValueError):
+        return False
+    return True
+
+def is_ip(s: str) -> bool:
+    """校验 IPv4/IPv6 地址字符串（detail 中 raddr 取值校验，避免把非 IP 内容写入 events）"""
+    try:
+        ipaddress.ip_address(s)
+    except ValueError:
+        return False
+    return True
+
 def ensure_dirs():
     """确保工作目录存在"""
     BASE.mkdir(parents=True, exist_ok=True)
     SNAP_DIR.mkdir(parents=True, exist_ok=True)
 
+_LOG_FH = None  # 日志文件句柄：进程内只打开一次，按块缓冲写入
+
+def _log_fh():
+    """获取日志文件句柄（首次调用时打开）"""
+    global _LOG_FH
+    if _LOG_FH is None:
+        ensure_dirs()
+        _LOG_FH = open(LOG_FILE, "a", encoding="utf-8", errors="ignore", buffering=1 << 16)
+    return _LOG_FH
+
+def flush_log():
+    """把缓冲中的日志落盘（每轮结束时调用，便于实时查看）"""
+    if _LOG_FH is not None:
+        try:
+            _LOG_FH.flush()
+        except Exception:
+            pass
+
+def close_log():
+    """关闭日志文件句柄（退出时）"""
+    global _LOG_FH
+    fh, _LOG_FH = _LOG_FH, None
+    if fh is not None:
+        try:
+            fh.close()
+        except Exception:
+            pass
+
+atexit.register(close_log)
+
 def append_log(msg: str):
-    """写日志到文件 + 控制台输出"""
-    ensure_dirs()
+    """写日志到文件（缓冲，见 flush_log）+ 控制台输出"""
     line = f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {msg}\n"
     try:
-        with open(LOG_FILE, "a", encoding="utf-8", errors="ignore") as f:
-            f.write(line)
+        _log_fh().write(line)
     except Exception:
         pass
     print(msg)
 
+@functools.lru_cache(maxsize=1)
 def is_admin() -> bool:
-    """判断是否管理员权限（net session 需要管理员）"""
-    p = subprocess.run(
-        ["powershell", "-NoProfile", "-Command", "net session"],
-        capture_output=True, text=True
-    )
+    """判断是否管理员权限（net session 需要管理员；进程内结果不变，只检查一次）"""
+    try:
+        p = subprocess.run(["net", "session"], capture_output=True, text=True)
+    except OSError:
+        return False
     return p.returncode == 0
 
 def run_ps(cmd: str) -> subprocess.CompletedProcess:
@@ -142,71 +230,70 @@ def run_ps(cmd: str) -> subprocess.CompletedProcess:
         capture_output=True, text=True
     )
 
+def _is_snapshot_dir_name(name: str) -> bool:
+    """目录名是否为 YYYYMMDD_HHMMSS"""
+    return len(name) == 15 and name[8] == "_" and name[:8].isdigit() and name[9:].isdigit()
+
 def cleanup_snapshots_keep_last_n():
     """
     快照清理：只保留最近 SNAPSHOT_KEEP_MAX 个快照目录。
     仅删除目录名符合 YYYYMMDD_HHMMSS 的目录，避免误删其他文件夹。
+    该格式按字符串排序即按时间排序，无需解析日期。
     """
     if not SNAP_DIR.exists():
         return
 
-    items = []
-    for p in SNAP_DIR.iterdir():
-        if not p.is_dir():
-            continue
-        try:
-            dt = datetime.strptime(p.name, "%Y%m%d_%H%M%S")
-            ts = int(dt.timestamp())
-            items.append((ts, p))
-        except Exception:
-            continue
+    with os.scandir(SNAP_DIR) as it:
+        entries = [
+            (e.name, e.path) for e in it
+            if e.is_dir(follow_symlinks=False) and _is_snapshot_dir_name(e.name)
+        ]
 
-    items.sort(key=lambda x: x[0], reverse=True)
+    entries.sort(reverse=True)
 
-    for _, p in items[SNAPSHOT_KEEP_MAX:]:
+    for name, path in entries[SNAPSHOT_KEEP_MAX:]:
         try:
-            shutil.rmtree(p, ignore_errors=True)
-            append_log(f"SNAP_CLEAN 已删除旧快照：{p.name}")
+            shutil.rmtree(path, ignore_errors=True)
+            append_log(f"SNAP_CLEAN 已删除旧快照：{name}")
         except Exception as e:
-            append_log(f"SNAP_CLEAN 删除失败：{p.name}，错误：{e}")
+            append_log(f"SNAP_CLEAN 删除失败：{name}，错误：{e}")
+
+_LOCK_FD = None  # 持有锁的文件描述符（进程存活期间保持打开）
 
 def acquire_lock():
     """
-    简单锁文件：防止你手误启动两份导致重复跑。
-    处理“上次异常退出遗留锁”的情况：如果 PID 不存在就自动清掉锁。
+    进程互斥：防止你手误启动两份导致重复跑。
+    对锁文件加操作系统级排他锁（Windows: msvcrt.locking；其他平台: fcntl.flock），
+    锁随进程退出由系统自动释放：不存在“异常退出遗留锁”，也没有先检查再创建的竞态。
     """
+    global _LOCK_FD
     ensure_dirs()
 
-    if LOCK_FILE.exists():
-        try:
-            pid = int(LOCK_FILE.read_text(encoding="utf-8", errors="ignore").strip() or "0")
-        except Exception:
-            pid = 0
-
-        # 尝试判断进程是否存在（Windows：tasklist）
-        alive = False
-        if pid > 0:
-            p = subprocess.run(
-                ["powershell", "-NoProfile", "-Command", f"Get-Process -Id {pid} -ErrorAction SilentlyContinue | Select -First 1"],
-                capture_output=True, text=True
-            )
-            alive = bool((p.stdout or "").strip())
-
-        if alive:
-            raise RuntimeError(f"检测到锁文件，可能已有实例在运行：{LOCK_FILE}（pid={pid}）")
+    fd = os.open(str(LOCK_FILE), os.O_CREAT | os.O_RDWR)
+    try:
+        if os.name == "nt":
+            import msvcrt
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
         else:
-            try:
-                LOCK_FILE.unlink()
-            except Exception:
-                pass
+            import fcntl
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        raise RuntimeError(f"检测到锁文件已被占用，可能已有实例在运行：{LOCK_FILE}")
 
-    LOCK_FILE.write_text(str(os.getpid()), encoding="utf-8", errors="ignore")
+    # 记录 PID 便于排查（锁本身不依赖文件内容）
+    os.ftruncate(fd, 0)
+    os.write(fd, str(os.getpid()).encode("ascii"))
+    _LOCK_FD = fd
 
 def release_lock():
-    """释放锁文件"""
+    """释放锁（关闭描述符即解锁；锁文件保留，避免删除与他人加锁之间的竞态）"""
+    global _LOCK_FD
+    fd, _LOCK_FD = _LOCK_FD, None
+    if fd is None:
+        return
     try:
-        if LOCK_FILE.exists():
-            LOCK_FILE.unlink()
+        os.close(fd)
     except Exception:
         pass
 
@@ -217,8 +304,7 @@ def write_csv(path: Path, header, rows):
         with open(path, "w", newline="", encoding="utf-8-sig") as f:
             w = csv.writer(f)
             w.writerow(header)
-            for r in rows:
-                w.writerow(r)
+            w.writerows(rows)
     except Exception as e:
         append_log(f"CSV 写入失败：{path}，错误：{e}")
 
@@ -226,130 +312,249 @@ def write_csv(path: Path, header, rows):
 # 数据库：state.db
 # =========================
 
+_STATE_CONN = None  # 进程内共享的 state.db 连接（见 _get_conn）
+
+def _apply_state_pragmas(conn: sqlite3.Connection):
+    """
+    state.db 连接参数：
+    - WAL：写入不阻塞读取，提交只需一次 fsync
+    - synchronous=NORMAL：WAL 模式下安全，大幅降低提交开销
+    - cache_size=-20000：约 20MB 页缓存（负数单位为 KB）
+    - mmap_size=256MB：通过内存映射读页，减少 read 系统调用
+    - temp_store=MEMORY：GROUP BY / 排序的临时表放内存
+    """
+    mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    if str(mode).lower() != "wal":
+        # 例如 state.db 位于不支持共享内存的文件系统：仍可运行，但写入会阻塞读取
+        append_log(f"警告：state.db 未能切换到 WAL 模式（当前 {mode}）")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA temp_store=MEMORY")
+
+def _get_conn() -> sqlite3.Connection:
+    """
+    获取共享的 state.db 连接（首次调用时打开并设置 PRAGMA）。
+    isolation_level=None：由调用方显式 BEGIN IMMEDIATE，配合 `with conn:` 提交/回滚。
+    写事务一律用 BEGIN IMMEDIATE：开始即取得写锁，避免读锁中途升级写锁时才遇到 SQLITE_BUSY。
+    """
+    global _STATE_CONN
+    if _STATE_CONN is None:
+        ensure_dirs()
+        conn = sqlite3.connect(str(STATE_DB), isolation_level=None, check_same_thread=False)
+        _apply_state_pragmas(conn)
+        _STATE_CONN = conn
+    return _STATE_CONN
+
+def close_state_db():
+    """关闭共享连接（退出前执行 PRAGMA optimize，更新查询规划统计）"""
+    global _STATE_CONN
+    conn, _STATE_CONN = _STATE_CONN, None
+    if conn is None:
+        return
+    try:
+        conn.execute("PRAGMA optimize")
+    except Exception:
+        pass
+    conn.close()
+
+# 兜底：run_once() 被其他脚本直接调用、或异常退出未走到 main() 的 finally 时，也能正常关闭
+atexit.register(close_state_db)
+
 def ensure_state_db():
     """初始化 state.db 结构"""
-    ensure_dirs()
-    conn = sqlite3.connect(str(STATE_DB))
-    cur = conn.cursor()
+    conn = _get_conn()
+    had_covering = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_events_ts_ip'"
+    ).fetchone() is not None
+    had_bucket = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='events_bucket'"
+    ).fetchone() is not None
+
+    with conn:
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
 
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS meta(
-      k TEXT PRIMARY KEY,
-      v TEXT NOT NULL
-    )""")
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS meta(
+          k TEXT PRIMARY KEY,
+          v TEXT NOT NULL
+        )""")
 
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS events(
-      ts INTEGER NOT NULL,
-      ip TEXT NOT NULL
-    )""")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_events_ts ON events(ts)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_events_ip_ts ON events(ip, ts)")
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS events(
+          ts INTEGER NOT NULL,
+          ip TEXT NOT NULL
+        )""")
+        # (ts, ip) 覆盖索引：窗口统计/报表（ts>=? 的 COUNT / COUNT DISTINCT ip / GROUP BY ip）只读索引
+        #   注意：GROUP BY ip 时规划器倾向于整扫 (ip, ts) 以省掉排序，窗口查询需用 INDEXED BY 指定本索引
+        # (ip, ts)：按 IP 取证查询
+        cur.execute("DROP INDEX IF EXISTS idx_events_ts")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_events_ts_ip ON events(ts, ip)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_events_ip_ts ON events(ip, ts)")
+
+        # 按小时预聚合的命中数：24h 窗口统计读 ~24 个桶/IP，而不是逐条扫描 events
+        # 主键 (hour_ts, ip)：窗口查询按 hour_ts 范围定位；WITHOUT ROWID 使表本身即覆盖索引
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS events_bucket(
+          hour_ts INTEGER NOT NULL,
+          ip TEXT NOT NULL,
+          hits INTEGER NOT NULL,
+          PRIMARY KEY(hour_ts, ip)
+        ) WITHOUT ROWID""")
+        if not had_bucket:
+            # 升级旧库：由现有 events 回填
+            cur.execute("""
+              INSERT INTO events_bucket(hour_ts, ip, hits)
+              SELECT ts - ts % 3600, ip, COUNT(*) FROM events GROUP BY 1, 2
+            """)
 
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS stats(
-      ip TEXT PRIMARY KEY,
-      first_seen INTEGER,
-      last_seen INTEGER,
-      hits_total INTEGER DEFAULT 0
-    )""")
-
-    # bans 表：记录临时/永久封禁
-    # expires_at 为 NULL 表示永久封禁
-    # kind: 'temp' 或 'perm'
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS bans(
-      ip TEXT PRIMARY KEY,
-      rule_name TEXT NOT NULL,
-      kind TEXT NOT NULL,
-      banned_at INTEGER NOT NULL,
-      expires_at INTEGER,
-      reason TEXT NOT NULL
-    )""")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_bans_kind ON bans(kind)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_bans_expires ON bans(expires_at)")
-
-    # drops 表：记录防火墙 DROP 事件（用于验证封禁后是否仍在尝试）
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS drops(
-      ts INTEGER NOT NULL,
-      ip TEXT NOT NULL
-    )""")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_drops_ts ON drops(ts)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_drops_ip_ts ON drops(ip, ts)")
-
-    conn.commit()
-    conn.close()
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS stats(
+          ip TEXT PRIMARY KEY,
+          first_seen INTEGER,
+          last_seen INTEGER,
+          hits_total INTEGER DEFAULT 0
+        )""")
+        # 永久封禁候选：hits_total >= 阈值走索引范围查找
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_stats_hits ON stats(hits_total)")
+
+        # bans 表：记录临时/永久封禁
+        # expires_at 为 NULL 表示永久封禁
+        # kind: 'temp' 或 'perm'
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS bans(
+          ip TEXT PRIMARY KEY,
+          rule_name TEXT NOT NULL,
+          kind TEXT NOT NULL,
+          banned_at INTEGER NOT NULL,
+          expires_at INTEGER,
+          reason TEXT NOT NULL
+        )""")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_bans_kind ON bans(kind)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_bans_expires ON bans(expires_at)")
+
+        # drops 表：记录防火墙 DROP 事件（用于验证封禁后是否仍在尝试）
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS drops(
+          ts INTEGER NOT NULL,
+          ip TEXT NOT NULL
+        )""")
+        cur.execute("DROP INDEX IF EXISTS idx_drops_ts")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_drops_ts_ip ON drops(ts, ip)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_drops_ip_ts ON drops(ip, ts)")
+
+    # 新建索引后收集一次统计信息，让查询规划器选中覆盖索引
+    if not had_covering:
+        conn.execute("ANALYZE")
 
 def get_meta(k: str, default: str = "0") -> str:
     """读取 meta 键值"""
-    conn = sqlite3.connect(str(STATE_DB))
-    cur = conn.cursor()
-    cur.execute("SELECT v FROM meta WHERE k=?", (k,))
-    row = cur.fetchone()
-    conn.close()
+    row = _get_conn().execute("SELECT v FROM meta WHERE k=?", (k,)).fetchone()
     return row[0] if row else default
 
 def set_meta(k: str, v: str):
-    """写入 meta 键值"""
-    conn = sqlite3.connect(str(STATE_DB))
-    cur = conn.cursor()
-    cur.execute(
+    """写入 meta 键值（单条语句，自动提交）"""
+    _get_conn().execute(
         "INSERT INTO meta(k,v) VALUES(?,?) ON CONFLICT(k) DO UPDATE SET v=excluded.v",
         (k, str(v))
     )
-    conn.commit()
-    conn.close()
 
 def update_state_with_events(events):
     """
     events: list[(ts:int, ip:str)]
     - 写入 events
-    - 更新 stats（首次/最后出现/累计次数）
-    - 清理超出 EVENT_RETENTION_DAYS 的旧 events
+    - 更新 stats（首次/最后出现/累计次数）：先在内存按 IP 聚合，再批量 UPSERT
+    - 更新 events_bucket（按 IP + 整点小时累加命中数）
+    - 清理超出 EVENT_RETENTION_DAYS 的旧 events / 已整体过期的小时桶
+    全部在同一个事务内完成。
     """
     if not events:
         return
 
-    conn = sqlite3.connect(str(STATE_DB))
-    cur = conn.cursor()
-
-    cur.executemany("INSERT INTO events(ts, ip) VALUES(?,?)", events)
-
+    # 按 IP 预聚合：ip -> [min_ts, max_ts, count]；按 (小时, IP) 预聚合：(hour_ts, ip) -> count
+    agg = {}
+    buckets = {}
     for ts, ip in events:
-        cur.execute("SELECT first_seen, last_seen, hits_total FROM stats WHERE ip=?", (ip,))
-        row = cur.fetchone()
-        if not row:
-            cur.execute(
-                "INSERT INTO stats(ip, first_seen, last_seen, hits_total) VALUES(?,?,?,?)",
-                (ip, ts, ts, 1)
-            )
+        hk = (ts - ts % 3600, ip)
+        buckets[hk] = buckets.get(hk, 0) + 1
+        a = agg.get(ip)
+        if a is None:
+            agg[ip] = [ts, ts, 1]
         else:
-            first_seen, last_seen, hits_total = row
-            if first_seen is None:
-                first_seen = ts
-            if last_seen is None or ts > last_seen:
-                last_seen = ts
-            hits_total = (hits_total or 0) + 1
-            cur.execute(
-                "UPDATE stats SET first_seen=?, last_seen=?, hits_total=? WHERE ip=?",
-                (first_seen, last_seen, hits_total, ip)
-            )
+            if ts < a[0]:
+                a[0] = ts
+            if ts > a[1]:
+                a[1] = ts
+            a[2] += 1
+    agg_rows = [(ip, a[0], a[1], a[2]) for ip, a in agg.items()]
 
     keep_from = now_ts() - EVENT_RETENTION_DAYS * 86400
-    cur.execute("DELETE FROM events WHERE ts < ?", (keep_from,))
 
-    conn.commit()
-    conn.close()
+    conn = _get_conn()
+    with conn:
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        cur.executemany("INSERT INTO events(ts, ip) VALUES(?,?)", events)
+        cur.executemany("""
+          INSERT INTO stats(ip, first_seen, last_seen, hits_total) VALUES(?,?,?,?)
+          ON CONFLICT(ip) DO UPDATE SET
+            first_seen=min(COALESCE(first_seen, excluded.first_seen), excluded.first_seen),
+            last_seen=max(COALESCE(last_seen, excluded.last_seen), excluded.last_seen),
+            hits_total=COALESCE(hits_total, 0) + excluded.hits_total
+        """, agg_rows)
+        cur.executemany("""
+          INSERT INTO events_bucket(hour_ts, ip, hits) VALUES(?,?,?)
+          ON CONFLICT(hour_ts, ip) DO UPDATE SET hits = hits + excluded.hits
+        """, [(h, ip, n) for (h, ip), n in buckets.items()])
+        cur.execute("DELETE FROM events WHERE ts < ?", (keep_from,))
+        cur.execute("DELETE FROM events_bucket WHERE hour_ts + 3600 <= ?", (keep_from,))
 
 # =========================
 # 火绒快照读取
 # =========================
 
+def fast_copy(src: Path, dst: Path):
+    """
+    复制单个文件（保留时间戳/属性，等价 shutil.copy2）。
+    Windows 上直接调用 kernel32.CopyFileExW：由系统按区段复制，不经过 Python 层缓冲读写；
+    非 Windows 或调用失败（例如源文件被独占打开）时回退 shutil.copy2。
+    """
+    if os.name == "nt":
+        try:
+            import ctypes
+            if ctypes.windll.kernel32.CopyFileExW(str(src), str(dst), None, None, None, 0):
+                return
+        except Exception:
+            pass
+    shutil.copy2(src, dst)
+
+def backup_huorong_db(dst_db: Path):
+    """
+    用 SQLite 在线备份 API 把火绒 log.db 导出为单文件快照：
+    - 只读 URI 打开源库，不会修改火绒数据
+    - WAL 中已提交的数据一并带上，结果是一致的单文件
+    - 一步复制完（默认 pages=-1）：全程处于源库同一个读快照内，火绒并发写入不影响结果；
+      不用分步复制——分步时源库每有写入，备份就会从头重来，火绒持续写入（例如正遭受爆破）时可能永远完不成
+    - 快照是一次性只读副本：目标库关闭日志与 fsync，写入只剩纯顺序写
+    """
+    src = sqlite3.connect(LOG_DB.as_uri() + "?mode=ro", uri=True, timeout=5)
+    try:
+        dst = sqlite3.connect(str(dst_db))
+        try:
+            dst.execute("PRAGMA journal_mode=OFF")
+            dst.execute("PRAGMA synchronous=OFF")
+            src.backup(dst)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+
 def mirror_huorong_db() -> Path:
     """
-    将火绒 log.db（以及 wal/shm）复制到快照目录，避免被占用/锁导致读取失败。
-    并在复制前执行“只保留最近 N 个快照”的清理策略。
+    将火绒 log.db 导出到快照目录，避免被占用/锁导致读取失败。
+    优先走 SQLite 备份 API；失败时回退为复制 log.db（以及 wal/shm）文件。
+    并在导出前执行“只保留最近 N 个快照”的清理策略。
     返回快照中的 log.db 路径。
     """
     if not LOG_DB.exists():
@@ -360,173 +565,435 @@ def mirror_huorong_db() -> Path:
 
     snap = SNAP_DIR / time.strftime("%Y%m%d_%H%M%S")
     snap.mkdir(parents=True, exist_ok=True)
+    snap_db = snap / "log.db"
 
-    shutil.copy2(LOG_DB, snap / "log.db")
+    try:
+        backup_huorong_db(snap_db)
+        return snap_db
+    except sqlite3.Error as e:
+        append_log(f"SNAPSHOT 备份 API 失败，回退文件复制：{e}")
+
+    for p in snap.iterdir():
+        p.unlink()
+    fast_copy(LOG_DB, snap_db)
     if LOG_DB_WAL.exists():
-        shutil.copy2(LOG_DB_WAL, snap / "log.db-wal")
+        fast_copy(LOG_DB_WAL, snap / "log.db-wal")
     if LOG_DB_SHM.exists():
-        shutil.copy2(LOG_DB_SHM, snap / "log.db-shm")
+        fast_copy(LOG_DB_SHM, snap / "log.db-shm")
 
-    return snap / "log.db"
+    return snap_db
 
-def parse_ips_from_detail(detail: str):
+@functools.lru_cache(maxsize=1)
+def re_ip():
+    """编译 IP 提取正则（延迟到兜底路径第一次用到时，常规运行不付编译开销）"""
+    return (re2 or re).compile(RE_IP_PATTERN)
+
+def parse_ips_from_detail(detail: bytes):
     """
     从火绒 detail 字段解析攻击者 IP，返回 set[str]。
-    优先：json.loads（火绒常见是 JSON 字符串）
+    先做字节级预筛（不含 RDP 检测标记直接跳过，不进 JSON 解析器）
+    优先：顶层 detail 对象结构简单且其 detection 恰为 "RDP" 时，直接在字节串上定向提取
+          detail.raddr / detail.rdata.raddr[]，不构建 JSON 树
+    其次：JSON 解析（没有 raddr 字段、或不是规范 JSON 时；装了 orjson 则用 orjson）
     兜底：正则扫描（仅当检测字段像 RDP 时才扫描，降低误报）
     """
     ips = set()
     if not detail:
         return ips
-    s = str(detail).strip()
+    if isinstance(detail, str):
+        detail = detail.encode("utf-8", "ignore")
+
+    if not any(m in detail for m in RDP_DETAIL_MARKERS):
+        return ips
+
+    # 定向提取只在顶层 detail 对象内进行：detection 取 detail 自身字段，
+    # raddr 只取 detail.raddr（字符串）与 detail.rdata.raddr（数组），与 JSON 解析的取值范围一致；
+    # raddr 取值一律校验为合法 IP 才收录
+    m = RE_DETAIL_OBJ.search(detail)
+    if m:
+        prefix = detail[:m.start()]
+        own = (m.group(1) or b"") + (m.group(3) or b"")
+        if prefix.count(b"{") - prefix.count(b"}") == 1 and RE_DETECTION_RDP.search(own):
+            found = [one for one, _ in RE_RADDR.findall(own) if one]
+            for _, arr in RE_RADDR.findall(m.group(2) or b""):
+                found.extend(RE_JSON_STR.findall(arr))
+            for x in found:
+                x = x.decode("utf-8", "ignore")
+                if is_ip(x):
+                    ips.add(x)
+            if ips:
+                return ips
 
     try:
-        obj = json.loads(s)
+        obj = (orjson or json).loads(detail)
         d = obj.get("detail", {})
         if d.get("detection") != "RDP":
             return set()
 
         ra = d.get("raddr")
-        if isinstance(ra, str) and ra:
+        if isinstance(ra, str) and is_ip(ra):
             ips.add(ra)
 
         rdata = d.get("rdata", {})
         arr = rdata.get("raddr")
         if isinstance(arr, list):
             for x in arr:
-                if isinstance(x, str) and x:
+                if isinstance(x, str) and is_ip(x):
                     ips.add(x)
         return ips
     except Exception:
         pass
 
-    if ("detection" not in s) or ("RDP" not in s):
-        return set()
-    if '"detection":"RDP"' not in s and "'detection':'RDP'" not in s and "detection\":\"RDP" not in s:
-        return set()
-
-    for ip in RE_IP.findall(s):
-        ips.add(ip)
+    for ip in re_ip().findall(detail):
+        ips.add(ip.decode("ascii"))
     return ips
 
-def read_new_events_from_snapshot(snapshot_db: Path, last_ts: int):
+def open_huorong_live_db() -> sqlite3.Connection:
     """
-    增量读取：只取 ts > last_ts 且 fname='rlogin' 的记录
-    返回 (events, max_ts_seen)
+    以只读方式直接打开火绒 log.db（不复制文件）：
+    - mode=ro + query_only：本连接不会对火绒数据库做任何写入
+    - 正常参与 SQLite 锁与 WAL 协议（不使用 nolock），读到的是一致的已提交数据
+    被占用/锁定时抛出 sqlite3.Error，由调用方回退到快照方式
     """
-    conn = sqlite3.connect(str(snapshot_db))
+    conn = sqlite3.connect(LOG_DB.as_uri() + "?mode=ro", uri=True, timeout=5)
+    try:
+        conn.execute("PRAGMA query_only=1")
+    except sqlite3.Error:
+        conn.close()
+        raise
+    return conn
+
+def _rdp_ips_udf(detail):
+    """SQLite 自定义函数 rdp_ips(detail)：返回以换行分隔的攻击者 IP；没有则返回 NULL"""
+    # 函数内抛出的异常会让整条查询失败（“user-defined function raised exception”），
+    # 单行 detail 异常不应拖垮整轮读取：按“无法解析”处理
+    try:
+        ips = parse_ips_from_detail(detail)
+    except Exception:
+        return None
+    return "\n".join(ips) if ips else None
+
+def read_new_events(conn: sqlite3.Connection, last_ts: int, last_rowid: int = 0):
+    """
+    增量读取：只取 ts > last_ts 且 fname='rlogin' 的记录（conn 为火绒库或其快照，由调用方关闭）
+    火绒日志表是追加写入的 rowid 表：额外用 rowid > last_rowid 在表 B 树上做范围定位，
+    每轮只访问新追加的行，而不是全表扫描 fname/detail。
+    IP 解析注册为 SQLite 函数 rdp_ips()，结果集直接是 (ts, ips)，Python 侧只做展开。
+    返回 (events, max_ts_seen, max_rowid)；表为 WITHOUT ROWID 时 max_rowid 为 None
+    """
+    # CAST AS BLOB：detail 以 bytes 传入，预筛/JSON 解析都直接吃 bytes，免去解码
+    conn.create_function("rdp_ips", 1, _rdp_ips_udf, deterministic=True)
     cur = conn.cursor()
 
-    sql = f"""
-    SELECT ts, detail
-    FROM {HUORONG_TABLE}
-    WHERE fname='rlogin'
+    # 与 parse_ips_from_detail 的字节预筛完全一致：用 instr() 做定长子串查找，让 SQLite 先在库内丢弃无关行
+    # （instr 是逐字节比较，比 LIKE '%...%' 的通配匹配 + 大小写折叠更轻）
+    markers = [m.decode("utf-8") for m in RDP_DETAIL_MARKERS]
+    marker_cond = " OR ".join(["instr(detail, ?) > 0"] * len(markers))
+    # 不在 WHERE 里再写 rdp_ips(...) IS NOT NULL：SQLite 会对命中行把函数再算一遍
+    sql = """
+    SELECT CAST(ts AS INTEGER), rdp_ips(CAST(detail AS BLOB))
+    FROM {table}
+    WHERE {rowid_cond}fname='rlogin'
       AND ts > ?
-      AND detail LIKE '%detection%'
+      AND ({marker_cond})
     ORDER BY ts ASC
     """
-    cur.execute(sql, (last_ts,))
-    rows = cur.fetchall()
-    conn.close()
-
-    out = []
-    max_ts = last_ts
+    # 只有明确是 WITHOUT ROWID 表才退回纯 ts 过滤；其它 OperationalError（如库被锁）照常抛出，
+    # 由调用方走快照兜底，不能当成“没有 rowid”把水位清零
+    row = cur.execute(
+        "SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (HUORONG_TABLE,)
+    ).fetchone()
+    if row and "WITHOUT ROWID" in (row[0] or "").upper():
+        # 返回 max_rowid=None：调用方保留已存的 last_rowid
+        max_rowid = None
+        cur.execute(
+            sql.format(table=HUORONG_TABLE, rowid_cond="", marker_cond=marker_cond),
+            (last_ts, *markers)
+        )
+    else:
+        max_rowid = cur.execute(f"SELECT max(rowid) FROM {HUORONG_TABLE}").fetchone()[0] or 0
+        if max_rowid < last_rowid:
+            # 表被清空/重建（rowid 回退）：水位作废，只靠 ts 过滤
+            last_rowid = 0
+        cur.execute(
+            sql.format(table=HUORONG_TABLE, rowid_cond="rowid > ? AND ", marker_cond=marker_cond),
+            (last_rowid, last_ts, *markers)
+        )
 
-    for ts, detail in rows:
-        if ts is None or detail is None:
-            continue
-        ips = parse_ips_from_detail(str(detail))
-        if not ips:
-            continue
-        for ip in ips:
-            out.append((int(ts), ip))
-        if int(ts) > max_ts:
-            max_ts = int(ts)
+    out = [(ts, ip) for ts, ips in cur if ips for ip in ips.split("\n")]
+    # 按 ts 升序返回，最后一条即最大 ts
+    max_ts = out[-1][0] if out else last_ts
 
-    return out, max_ts
+    return out, max_ts, max_rowid
 
 # =========================
 # 防火墙操作
 # =========================
 
-def fw_rule_exists(display_name: str) -> bool:
-    """判断防火墙规则是否存在"""
-    p = run_ps(f"Get-NetFirewallRule -DisplayName '{display_name}' -ErrorAction SilentlyContinue | Select -First 1")
-    return bool((p.stdout or "").strip())
+def run_netsh(*args) -> subprocess.CompletedProcess:
+    """
+    运行 `netsh advfirewall firewall ...`。
+    netsh 是原生程序，不需要启动 PowerShell/加载 NetSecurity 模块，单次调用为毫秒级。
+    规则名对应防火墙规则的 DisplayName，与旧版 PowerShell 创建的规则兼容。
+    """
+    try:
+        return subprocess.run(
+            ["netsh", "advfirewall", "firewall", *args],
+            capture_output=True, text=True
+        )
+    except OSError as e:
+        # 例如参数过长（WinError 206）：按失败处理，交给调用方拆分/重试
+        return subprocess.CompletedProcess(args, 1, "", str(e))
 
-def fw_remove_rule(display_name: str) -> bool:
-    """删除防火墙规则"""
-    p = run_ps(f"Get-NetFirewallRule -DisplayName '{display_name}' -ErrorAction SilentlyContinue | Remove-NetFirewallRule")
-    return p.returncode == 0
+_FW_RULES = None  # 本轮已知的 RDPGuard 规则名（DisplayName）集合；None 表示未知，逐条用 netsh 查询
+_FW_RULES_LISTED = False  # 本轮是否已尝试列出规则（列出失败时 _FW_RULES 仍为 None，不再重试）
+_FW_RULES_VERIFIED_AT = 0  # 上次成功核对聚合规则（列出全部规则）的时间
 
-def fw_create_block_rule_single_ip(ip: str, display_name: str) -> bool:
-    """创建单 IP 入站拦截规则"""
+def refresh_fw_rules():
+    """
+    一次 PowerShell 调用列出所有 RDPGuard 开头的防火墙规则名，缓存到 _FW_RULES，
+    之后的存在性判断直接查集合（不再每条规则调用一次 netsh show）。
+    查询失败时置为 None，退回逐条查询。
+    """
+    global _FW_RULES, _FW_RULES_LISTED
     cmd = (
-        f"New-NetFirewallRule -DisplayName '{display_name}' "
-        f"-Direction Inbound -Action Block -RemoteAddress {ip} -Profile Any"
+        f"$r = Get-NetFirewallRule -DisplayName '{RULE_PREFIX_TEMP}*' "
+        "-ErrorAction SilentlyContinue -ErrorVariable e; "
+        # 没有任何匹配规则时 Get-NetFirewallRule 报 ObjectNotFound，属正常情况；其他错误视为查询失败
+        "if ($e | Where-Object { $_.CategoryInfo.Category -ne 'ObjectNotFound' }) { exit 1 }; "
+        "$r | ForEach-Object { $_.DisplayName }; exit 0"
     )
     p = run_ps(cmd)
-    return p.returncode == 0
+    _FW_RULES_LISTED = True
+    if p.returncode == 0:
+        _FW_RULES = {line.strip() for line in (p.stdout or "").splitlines() if line.strip()}
+    else:
+        _FW_RULES = None
 
-def fw_upsert_permanent_pool_rule(ips):
-    """
-    创建/更新“永久封禁聚合规则”（一个规则合并很多 IP）：
-      DisplayName: RULE_POOL_NAME
-      RemoteAddress: ip1,ip2,...
+def reset_fw_rules():
+    """每轮开始时作废上一轮的规则列表（防火墙可能被外部修改）；本轮第一次真正需要时再列出"""
+    global _FW_RULES, _FW_RULES_LISTED
+    _FW_RULES = None
+    _FW_RULES_LISTED = False
 
-    注意：防火墙存在长度/数量限制；若失败则自动拆分为多个规则：RULE_POOL_NAME-1/-2/...
+def _fw_rules_known(display_name: str) -> bool:
     """
-    ips = sorted(set(ips))
-    if not ips:
-        return True
+    该规则名是否在 _FW_RULES 的覆盖范围内（已成功列出且名字带 RDPGuard 前缀）。
+    只有本轮确实要操作防火墙时才会走到这里，此时才列出规则（空闲轮不启动 PowerShell）。
+    """
+    if not display_name.startswith(RULE_PREFIX_TEMP):
+        return False
+    if not _FW_RULES_LISTED:
+        refresh_fw_rules()
+    return _FW_RULES is not None
 
-    remote = ",".join(ips)
+def fw_rule_exists(display_name: str) -> bool:
+    """判断防火墙规则是否存在（优先查 _FW_RULES；否则 netsh，找不到规则时返回非 0）"""
+    if _fw_rules_known(display_name):
+        return display_name in _FW_RULES
+    return run_netsh("show", "rule", f"name={display_name}").returncode == 0
 
-    # 尝试单规则
-    if not fw_rule_exists(RULE_POOL_NAME):
-        cmd = (
-            f"New-NetFirewallRule -DisplayName '{RULE_POOL_NAME}' "
-            f"-Direction Inbound -Action Block -RemoteAddress {remote} -Profile Any"
+def fw_remove_rule(display_name: str) -> bool:
+    """删除防火墙规则（同名规则全部删除）；已知不存在时不调用 netsh"""
+    if _fw_rules_known(display_name) and display_name not in _FW_RULES:
+        return False
+    ok = run_netsh("delete", "rule", f"name={display_name}").returncode == 0
+    if ok and _FW_RULES is not None:
+        _FW_RULES.discard(display_name)
+    return ok
+
+def fw_upsert_block_rule(display_name: str, remote: str) -> bool:
+    """创建/更新入站拦截规则：已存在则只改 remoteip，否则新建"""
+    if fw_rule_exists(display_name):
+        p = run_netsh("set", "rule", f"name={display_name}", "new", f"remoteip={remote}")
+    else:
+        p = run_netsh(
+            "add", "rule", f"name={display_name}",
+            "dir=in", "action=block", f"remoteip={remote}", "profile=any"
         )
-        p = run_ps(cmd)
-        if p.returncode == 0:
+    ok = p.returncode == 0
+    if ok and _FW_RULES is not None:
+        _FW_RULES.add(display_name)
+    return ok
+
+def collapse_remote_addrs(ips) -> list:
+    """
+    把 IP 集合合并为防火墙 remoteip 列表：相邻/连续的地址合并成 CIDR 网段
+    （例如整段 /24 只占 1 项而不是 256 项），单个地址仍写成 IP 本身；无法解析的地址直接跳过。
+    返回已排序（IPv4 在前）的字符串列表。
+    """
+    v4, v6 = [], []
+    for ip in set(ips):
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            continue
+        (v4 if addr.version == 4 else v6).append(addr)
+
+    out = []
+    for addrs in (v4, v6):
+        for net in ipaddress.collapse_addresses(addrs):
+            out.append(str(net.network_address) if net.prefixlen == net.max_prefixlen else str(net))
+    return out
+
+def ip_set_digest(ips) -> str:
+    """IP 集合摘要（调用方传入已排序列表），用于判断规则内容是否变化"""
+    return hashlib.blake2b(",".join(ips).encode("utf-8"), digest_size=16).hexdigest()
+
+def probe_max_chunk() -> int:
+    """
+    探测单条规则 remoteip 可容纳的最大条目数（POOL_CHUNK_MIN~POOL_CHUNK_MAX 之间二分）。
+    限制往往是命令行总长度（WinError 206），所以探测条目取 IPv4 最长形态（18 字符的 CIDR，
+    如 "240.100.100.100/31"），保证真实集合（单 IP / collapse_remote_addrs 合并出的网段）按该条数分片时不会更长。
+    地址取自 240.0.0.0/4（保留地址段，不会出现在真实流量中），写入临时规则 RULE_PROBE_NAME，探测完即删除。
+    """
+    # 每条都是 POOL_PROBE_ENTRY_LEN 字符
+    addrs = [
+        f"240.{100 + i // 7800}.{100 + (i // 78) % 100}.{100 + 2 * (i % 78)}/31"
+        for i in range(POOL_CHUNK_MAX)
+    ]
+    lo, hi = POOL_CHUNK_MIN, POOL_CHUNK_MAX
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if fw_upsert_block_rule(RULE_PROBE_NAME, ",".join(addrs[:mid])):
+            lo = mid
+        else:
+            hi = mid - 1
+    fw_remove_rule(RULE_PROBE_NAME)
+    append_log(f"聚合规则单条容量探测结果：{lo} 个条目")
+    return lo
+
+def pool_chunk_size(n_ips: int) -> int:
+    """
+    聚合规则单条 IP 数：首次遇到超过 POOL_CHUNK_MIN 的集合时探测一次并缓存到 meta，
+    之后直接读取缓存，不再走“单规则失败 → 拆分”的重试流程。
+    """
+    cached = get_meta("pool_chunk_size", "")
+    if cached.isdigit():
+        return int(cached)
+    if n_ips <= POOL_CHUNK_MIN:
+        return POOL_CHUNK_MIN
+    size = probe_max_chunk()
+    set_meta("pool_chunk_size", str(size))
+    return size
+
+def _remove_pool_chunks(pool_name: str, start: int, end: int):
+    """删除聚合规则的分片 pool_name-start .. pool_name-end，并清除对应摘要"""
+    for k in range(start, end + 1):
+        name = f"{pool_name}-{k}"
+        fw_remove_rule(name)
+        set_meta(f"pool_hash:{name}", "")
+
+def _split_pool_entries(entries, chunk_size: int) -> list:
+    """
+    按探测容量把 remoteip 条目切成若干分片：每片不超过 chunk_size 条，
+    且拼接长度不超过“chunk_size 条探测条目”的长度（IPv6 等更长的条目会让分片自动变小）。
+    """
+    budget = chunk_size * (POOL_PROBE_ENTRY_LEN + 1)
+    chunks, cur, cur_len = [], [], 0
+    for e in entries:
+        n = len(e) + 1
+        if cur and (len(cur) >= chunk_size or cur_len + n > budget):
+            chunks.append(cur)
+            cur, cur_len = [], 0
+        cur.append(e)
+        cur_len += n
+    if cur:
+        chunks.append(cur)
+    return chunks
+
+def fw_upsert_pool_rule(pool_name: str, ips) -> bool:
+    """
+    创建/更新“聚合封禁规则”（一个规则合并很多 IP）：
+      DisplayName: pool_name
+      RemoteAddress: ip1,ip2,...（连续地址先经 collapse_remote_addrs 合并为 CIDR）
+
+    注意：防火墙存在长度/数量限制；单条容量由 pool_chunk_size() 探测并缓存，
+    超出时直接拆分为多个规则：pool_name-1/-2/...（分片数记录在 meta，集合缩小时删除多余分片）
+    IP 集合摘要记录在 meta 中：集合未变化时直接跳过（不调用 netsh）；
+    拆分模式下每个分片单独记录摘要，只更新内容有变化的分片。
+    集合为空时删除该聚合规则（及其分片）。
+    """
+    ips = collapse_remote_addrs(ips)
+    hash_key = f"pool_hash:{pool_name}"
+    chunks_key = f"pool_chunks:{pool_name}"
+
+    digest = ip_set_digest(ips)
+    old_chunks = int(get_meta(chunks_key, "0"))
+
+    if digest == get_meta(hash_key, ""):
+        # 集合未变化：本轮规则名已列出时（定期核对，或本轮已有其它防火墙操作）顺带核对规则仍在
+        # （被手动删除等），缺失则重新下发；未列出时不为核对专门启动 PowerShell
+        if not ips or _FW_RULES is None:
             return True
-    else:
-        cmd = f"Set-NetFirewallRule -DisplayName '{RULE_POOL_NAME}' -RemoteAddress {remote}"
-        p = run_ps(cmd)
-        if p.returncode == 0:
+        expected = [f"{pool_name}-{k}" for k in range(1, old_chunks + 1)] if old_chunks else [pool_name]
+        if all(name in _FW_RULES for name in expected):
             return True
+        append_log(f"检测到聚合规则 {pool_name} 缺失，重新下发")
 
-    # 单规则失败：拆分（先移除主规则，避免混乱）
-    if fw_rule_exists(RULE_POOL_NAME):
-        fw_remove_rule(RULE_POOL_NAME)
+    if not ips:
+        fw_remove_rule(pool_name)
+        _remove_pool_chunks(pool_name, 1, old_chunks)
+        set_meta(chunks_key, "0")
+        set_meta(hash_key, digest)
+        return True
 
-    chunk_size = 500  # 保守一点，避免 PowerShell 参数过长
-    ok_all = True
-    for i in range(0, len(ips), chunk_size):
-        chunk = ips[i:i + chunk_size]
-        name = f"{RULE_POOL_NAME}-{(i // chunk_size) + 1}"
-        remote_chunk = ",".join(chunk)
+    chunk_size = pool_chunk_size(len(ips))
+    chunks = _split_pool_entries(ips, chunk_size)
+
+    # 容量足够：单规则
+    if len(chunks) == 1:
+        if fw_upsert_block_rule(pool_name, ",".join(ips)):
+            _remove_pool_chunks(pool_name, 1, old_chunks)
+            set_meta(chunks_key, "0")
+            set_meta(hash_key, digest)
+            return True
+        # 缓存的容量不可靠（系统/策略变化）：清除缓存，下次重新探测；本轮按保守值拆分
+        set_meta("pool_chunk_size", "")
+        chunks = _split_pool_entries(ips, POOL_CHUNK_MIN)
 
-        if fw_rule_exists(name):
-            p = run_ps(f"Set-NetFirewallRule -DisplayName '{name}' -RemoteAddress {remote_chunk}")
+    # 拆分模式：先写分片，主规则（旧集合）保留到分片全部成功后再删，期间不出现无保护窗口
+    ok_all = True
+    n_chunks = 0
+    for chunk in chunks:
+        n_chunks += 1
+        name = f"{pool_name}-{n_chunks}"
+        chunk_key = f"pool_hash:{name}"
+        chunk_digest = ip_set_digest(chunk)
+        if chunk_digest == get_meta(chunk_key, "") and fw_rule_exists(name):
+            continue
+        if fw_upsert_block_rule(name, ",".join(chunk)):
+            set_meta(chunk_key, chunk_digest)
         else:
-            p = run_ps(
-                f"New-NetFirewallRule -DisplayName '{name}' -Direction Inbound -Action Block "
-                f"-RemoteAddress {remote_chunk} -Profile Any"
-            )
-        if p.returncode != 0:
+            set_meta(chunk_key, "")
             ok_all = False
 
+    # 集合缩小后多出来的旧分片
+    _remove_pool_chunks(pool_name, n_chunks + 1, old_chunks)
+    set_meta(chunks_key, str(n_chunks))
+
+    if ok_all:
+        # 分片已全部生效：最后删除主规则（不存在时 netsh 返回失败，忽略即可）
+        fw_remove_rule(pool_name)
+    else:
+        # 分片也失败：容量缓存可能偏大，下次重新探测
+        set_meta("pool_chunk_size", "")
+    set_meta(hash_key, digest if ok_all else "")
     return ok_all
 
 # =========================
 # 防火墙 DROP 日志（pfirewall.log）
 # =========================
 
+_FW_DROP_LOGGING_OK = False  # 本进程内已成功开启 DROP 日志则不再重复下发
+
 def ensure_firewall_drop_logging():
-    """确保 Windows 防火墙开启丢弃日志（管理员运行）"""
-    if not ENABLE_FW_DROP_LOG:
+    """
+    确保 Windows 防火墙开启丢弃日志（管理员运行）。
+    配置在进程内只下发一次（启动时）；找不到日志文件时会重置，下一轮重新下发。
+    """
+    global _FW_DROP_LOGGING_OK
+    if not ENABLE_FW_DROP_LOG or _FW_DROP_LOGGING_OK:
         return
 
     cmd = (
@@ -537,21 +1004,46 @@ def ensure_firewall_drop_logging():
     )
     p = run_ps(cmd)
     if p.returncode == 0:
+        _FW_DROP_LOGGING_OK = True
         append_log("已确保开启防火墙 DROP 日志")
     else:
         err = (p.stderr or "").strip()
         append_log(f"警告：开启防火墙 DROP 日志失败：{err if err else '未知错误'}")
 
+@functools.lru_cache(maxsize=2048)
+def fw_log_ts(date_s: str, time_s: str) -> int:
+    """
+    pfirewall.log 的本地时间（"YYYY-MM-DD", "HH:MM:SS"）转 Unix 时间戳。
+    格式固定，直接切片取整数再交给 time.mktime（C 实现，按本地时区/夏令时换算），
+    避免逐行 strptime；
+    同一秒内的突发日志直接命中缓存。格式不符或字段越界时抛 ValueError
+    （mktime 会把越界字段自动进位，如 13 月变成次年 1 月，所以先自行校验范围）。
+    """
+    if (len(date_s) != 10 or len(time_s) != 8 or date_s[4] != "-" or date_s[7] != "-"
+            or time_s[2] != ":" or time_s[5] != ":"):
+        raise ValueError(f"bad timestamp: {date_s} {time_s}")
+    digits = date_s[:4] + date_s[5:7] + date_s[8:] + time_s[:2] + time_s[3:5] + time_s[6:]
+    if not (digits.isascii() and digits.isdigit()):
+        raise ValueError(f"bad timestamp: {date_s} {time_s}")
+    y, mo, d = int(date_s[:4]), int(date_s[5:7]), int(date_s[8:10])
+    h, mi, sec = int(time_s[:2]), int(time_s[3:5]), int(time_s[6:8])
+    if not (1 <= mo <= 12 and 1 <= d <= calendar.monthrange(y, mo)[1]
+            and h <= 23 and mi <= 59 and sec <= 59):
+        raise ValueError(f"bad timestamp: {date_s} {time_s}")
+    return int(time.mktime((y, mo, d, h, mi, sec, 0, 0, -1)))
+
 def parse_firewall_drop_log_and_store():
     """
     增量解析 pfirewall.log，提取被 DROP 的 RDP 连接（dst-port=RDP_PORT）
     将 (ts, src_ip) 写入 drops 表。
     """
+    global _FW_DROP_LOGGING_OK
     if not ENABLE_FW_DROP_LOG:
         return
 
     if not FW_LOG.exists():
         append_log(f"未找到防火墙日志：{FW_LOG}")
+        _FW_DROP_LOGGING_OK = False
         return
 
     last_pos = int(get_meta("fwlog_pos", "0"))
@@ -564,67 +1056,76 @@ def parse_firewall_drop_log_and_store():
     # 文件被清空/轮转：从头读
     if size < last_pos:
         last_pos = 0
+    if size == last_pos:
+        return
 
     new_rows = []
     new_pos = last_pos
+    rdp_port = str(RDP_PORT)
 
     try:
-        with open(FW_LOG, "r", encoding="utf-8", errors="ignore") as f:
-            f.seek(last_pos)
-
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith("#"):
+        # mmap 只读映射，按字节切行：先做字节级包含判断，命中 DROP/TCP 的行才解码拆分
+        with open(FW_LOG, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            end = min(size, len(mm))
+            i = last_pos
+            while True:
+                j = mm.find(b"\n", i, end)
+                if j < 0:
+                    break  # 末尾不完整的行留到下一轮
+                line = mm[i:j]
+                i = j + 1
+
+                if b" DROP " not in line or b" TCP " not in line or line.startswith(b"#"):
                     continue
 
                 # Windows 防火墙日志默认字段：
                 # date time action protocol src-ip dst-ip src-port dst-port ...
-                parts = line.split()
+                parts = line.decode("ascii", "ignore").split()
                 if len(parts) < 8:
                     continue
 
                 date_s, time_s, action, proto = parts[0], parts[1], parts[2], parts[3]
-                if action.upper() != "DROP":
-                    continue
-                if proto.upper() != "TCP":
+                if action != "DROP" or proto != "TCP":
                     continue
 
                 src_ip = parts[4]
                 dst_port = parts[7]
 
-                if str(dst_port) != str(RDP_PORT):
+                if dst_port != rdp_port:
                     continue
-                if not RE_IP.fullmatch(src_ip):
+                if not is_ipv4(src_ip):
                     continue
 
                 try:
-                    dt = datetime.strptime(f"{date_s} {time_s}", "%Y-%m-%d %H:%M:%S")
-                    ts = int(dt.timestamp())
-                except Exception:
+                    ts = fw_log_ts(date_s, time_s)
+                except ValueError:
                     continue
 
                 new_rows.append((ts, src_ip))
 
-            new_pos = f.tell()
+            new_pos = i
     except Exception as e:
         append_log(f"DROP_LOG 读取失败：{e}")
         return
 
-    if new_rows:
-        conn = sqlite3.connect(str(STATE_DB))
+    # 写入 drops、清理过期数据、推进 fwlog_pos 在同一事务内完成：
+    # 要么全部生效，要么全部回滚（下一轮从原位置重读，不会丢数据也不会重复导入）
+    keep_from = now_ts() - EVENT_RETENTION_DAYS * 86400
+    conn = _get_conn()
+    with conn:
         cur = conn.cursor()
-        cur.executemany("INSERT INTO drops(ts, ip) VALUES(?,?)", new_rows)
-
-        keep_from = now_ts() - EVENT_RETENTION_DAYS * 86400
-        cur.execute("DELETE FROM drops WHERE ts < ?", (keep_from,))
-
-        conn.commit()
-        conn.close()
+        cur.execute("BEGIN IMMEDIATE")
+        if new_rows:
+            cur.executemany("INSERT INTO drops(ts, ip) VALUES(?,?)", new_rows)
+            cur.execute("DELETE FROM drops WHERE ts < ?", (keep_from,))
+        cur.execute(
+            "INSERT INTO meta(k,v) VALUES('fwlog_pos',?) ON CONFLICT(k) DO UPDATE SET v=excluded.v",
+            (str(new_pos),)
+        )
 
+    if new_rows:
         append_log(f"DROP_LOG 已导入 {len(new_rows)} 条（RDP_PORT={RDP_PORT}）")
 
-    set_meta("fwlog_pos", str(new_pos))
-
 # =========================
 # 封禁决策引擎
 # =========================
@@ -634,72 +1135,93 @@ def decide_and_apply_bans():
     - 自动解封已到期的临时封禁规则
     - 统计窗口命中次数（近 10 分钟、近 24 小时）
     - 永久封禁：stats.hits_total >= THRESH_TOTAL
-      -> 更新聚合规则，并在 bans(kind='perm') 记录
+      -> 更新永久聚合规则，并在 bans(kind='perm') 记录
     - 临时封禁：未永久封禁的 IP，满足窗口阈值
-      -> 创建单 IP 防火墙规则，记录 bans(kind='temp')
+      -> 记录 bans(kind='temp')，并按“当前未到期的临时封禁”重建临时聚合规则
+    解封只需从 bans 删除到期记录，再重建临时聚合规则（集合未变化时不调用 netsh）
+
+    分三步执行，防火墙调用不占用 state.db 写锁：
+    1) 读事务内算出到期记录、候选 IP、当前临时封禁集合（不调用防火墙）
+    2) 事务外执行 netsh/PowerShell
+    3) 短写事务内按防火墙结果落库：哪个聚合规则更新成功，就只写哪一部分
     """
+    global _FW_RULES_VERIFIED_AT
     now = now_ts()
     t10 = now - 10 * 60
     t1d = now - 24 * 3600
 
-    conn = sqlite3.connect(str(STATE_DB))
-    cur = conn.cursor()
+    conn = _get_conn()
+    with conn:
+        cur = conn.cursor()
+        # 只读：同一快照内取数，不持有写锁
+        cur.execute("BEGIN")
 
-    # 1) 解封到期的临时封禁
-    cur.execute("""
-      SELECT ip, rule_name FROM bans
-      WHERE kind='temp' AND expires_at IS NOT NULL AND expires_at <= ?
-    """, (now,))
-    expired = cur.fetchall()
-    for ip, rule_name in expired:
-        fw_remove_rule(rule_name)
-        append_log(f"解封 {ip}（临时封禁到期）")
-        cur.execute("DELETE FROM bans WHERE ip=?", (ip,))
+        # 1) 到期的临时封禁：删除记录即可（IP 随后从临时聚合规则中移除）
+        cur.execute("""
+          SELECT ip, rule_name FROM bans
+          WHERE kind='temp' AND expires_at IS NOT NULL AND expires_at <= ?
+        """, (now,))
+        expired = cur.fetchall()
+
+        # 2) 一条 SQL 取出所有“可能触发封禁”的 IP：(ip, 累计, 近10分钟, 近24小时, 当前封禁类型)
+        #    本轮到期的临时封禁视为未封禁（kind 为 NULL）：仍超阈值的 IP 在本轮直接重新封禁，
+        #    随本轮临时聚合规则一起重建，不会出现一整轮的放行空档
+        #    近24小时 = [h0, ∞) 的整点小时桶 + [t1d, h0) 的原始 events（不足一小时的头部）
+        #    近10分钟 = 原始 events（t10 必然晚于 h0，不与头部重叠）
+        #    原始 events 都在 (ts, ip) 覆盖索引上范围扫描；不满足任何阈值的 IP 不会进入 Python
+        h0 = t1d + (-t1d) % 3600  # t1d 向上取整到整点
+        #    候选 IP = 累计达标（stats.hits_total 索引范围查找）∪ 窗口达标，再按主键回查 stats，
+        #    不再整表扫描 stats（stats 随历史 IP 数只增不减）
+        cur.execute("""
+          WITH w AS (
+            SELECT ip, SUM(h10) AS h10, SUM(h1d) AS h1d
+            FROM (
+              SELECT ip, 0 AS h10, hits AS h1d
+              FROM events_bucket
+              WHERE hour_ts >= ?
+              UNION ALL
+              SELECT ip, 0, 1
+              FROM events INDEXED BY idx_events_ts_ip
+              WHERE ts >= ? AND ts < ?
+              UNION ALL
+              SELECT ip, 1, 0
+              FROM events INDEXED BY idx_events_ts_ip
+              WHERE ts >= ?
+            )
+            GROUP BY ip
+          )
+          SELECT s.ip, COALESCE(s.hits_total, 0), COALESCE(w.h10, 0), COALESCE(w.h1d, 0), b.kind
+          FROM (
+            SELECT ip FROM stats WHERE hits_total >= ?
+            UNION
+            SELECT ip FROM w WHERE h1d >= ? OR h10 >= ?
+          ) c
+          JOIN stats s ON s.ip = c.ip
+          LEFT JOIN w ON w.ip = c.ip
+          LEFT JOIN bans b ON b.ip = c.ip
+            AND NOT (b.kind = 'temp' AND b.expires_at IS NOT NULL AND b.expires_at <= ?)
+        """, (h0, t1d, h0, t10, THRESH_TOTAL, THRESH_1D, THRESH_10M, now))
+        candidates = cur.fetchall()
+
+        # 当前未到期的临时封禁（重建临时聚合规则用）
+        cur.execute("""
+          SELECT ip FROM bans
+          WHERE kind='temp' AND expires_at IS NOT NULL AND expires_at > ?
+        """, (now,))
+        active_temp = [ip for (ip,) in cur.fetchall()]
 
-    # 2) 统计近 24h 的窗口命中（同时得出近 10m 和近 1d）
-    cur.execute("""
-      SELECT ip,
-             SUM(CASE WHEN ts >= ? THEN 1 ELSE 0 END) AS hits_10m,
-             SUM(CASE WHEN ts >= ? THEN 1 ELSE 0 END) AS hits_1d
-      FROM events
-      WHERE ts >= ?
-      GROUP BY ip
-    """, (t10, t1d, t1d))
-    window = {ip: (h10 or 0, h1d or 0) for ip, h10, h1d in cur.fetchall()}
-
-    # 3) 累计命中
-    cur.execute("SELECT ip, hits_total FROM stats")
-    totals = {ip: (hits_total or 0) for ip, hits_total in cur.fetchall()}
-
-    # 4) 已封禁映射
-    cur.execute("SELECT ip, kind FROM bans")
-    banned_map = {ip: kind for ip, kind in cur.fetchall()}
-
-    # 5) 永久封禁集合（累计达到阈值）
-    perm_ips = [ip for ip, total in totals.items() if total >= THRESH_TOTAL]
-    if perm_ips:
-        ok = fw_upsert_permanent_pool_rule(perm_ips)
-        if ok:
-            for ip in perm_ips:
-                if banned_map.get(ip) == "perm":
-                    continue
-                cur.execute("""
-                  INSERT OR REPLACE INTO bans(ip, rule_name, kind, banned_at, expires_at, reason)
-                  VALUES (?,?,?,?,?,?)
-                """, (ip, RULE_POOL_NAME, "perm", now, None, f"累计>={THRESH_TOTAL}"))
-            append_log(f"已更新永久封禁聚合规则，永久封禁 IP 数：{len(perm_ips)}")
-        else:
-            append_log("错误：更新永久封禁聚合规则失败（可能是防火墙限制/权限问题）")
+    # 永久封禁集合（累计达到阈值）
+    perm_rows = [(ip, kind) for ip, total, _, _, kind in candidates if total >= THRESH_TOTAL]
+    perm_ips = [ip for ip, _ in perm_rows]
 
-    # 6) 临时封禁（只对非永久封禁、且未封禁的 IP 生效）
+    # 临时封禁（只对非永久封禁、且未封禁的 IP 生效）
     new_temp = []
-    for ip, total in totals.items():
+    for ip, total, h10, h1d, kind in candidates:
         if total >= THRESH_TOTAL:
             continue
-        if ip in banned_map:
+        if kind is not None:
             continue
 
-        h10, h1d = window.get(ip, (0, 0))
         reason = None
         expires_at = None
 
@@ -711,32 +1233,69 @@ def decide_and_apply_bans():
             expires_at = now + BAN_10M_HOURS * 3600
 
         if reason:
-            rule_name = f"{RULE_PREFIX_TEMP} {ip}"
-            new_temp.append((ip, rule_name, now, expires_at, reason))
-
-    # 批量应用临时封禁：限制一次最多处理数量，避免运行时间过长
-    max_apply = 200
-    applied = 0
-    for ip, rule_name, banned_at, expires_at, reason in new_temp:
-        if applied >= max_apply:
-            break
-
-        if not fw_rule_exists(rule_name):
-            ok = fw_create_block_rule_single_ip(ip, rule_name)
-            if not ok:
-                append_log(f"临时封禁失败 {ip}（原因：{reason}）")
-                continue
+            new_temp.append((ip, RULE_TEMP_POOL_NAME, now, expires_at, reason))
+
+    # ---- 事务外：防火墙操作 ----
+    # 规则列表按需获取：只有确实要调用 netsh 时才列出（摘要未变化的空闲轮不启动任何进程）；
+    # 每 FW_RULES_VERIFY_SECONDS 主动列出一次，用于发现被外部删除的聚合规则
+    reset_fw_rules()
+    if now - _FW_RULES_VERIFIED_AT >= FW_RULES_VERIFY_SECONDS:
+        refresh_fw_rules()
+        if _FW_RULES is not None:
+            _FW_RULES_VERIFIED_AT = now
+
+    # 旧版遗留的单 IP 规则（"RDPGuard <ip>"）在到期时单独删除
+    for ip, rule_name in expired:
+        if rule_name != RULE_TEMP_POOL_NAME:
+            fw_remove_rule(rule_name)
 
-        cur.execute("""
-          INSERT OR REPLACE INTO bans(ip, rule_name, kind, banned_at, expires_at, reason)
-          VALUES (?,?,?,?,?,?)
-        """, (ip, rule_name, "temp", banned_at, expires_at, reason))
+    perm_ok = False
+    if perm_ips:
+        perm_ok = fw_upsert_pool_rule(RULE_POOL_NAME, perm_ips)
+        if perm_ok:
+            append_log(f"已更新永久封禁聚合规则，永久封禁 IP 数：{len(perm_ips)}")
+        else:
+            append_log("错误：更新永久封禁聚合规则失败（可能是防火墙限制/权限问题）")
 
-        append_log(f"临时封禁 {ip}（{reason}），到期：{ts_to_local_str(expires_at)}")
-        applied += 1
+    # 重建临时聚合规则：未到期的临时封禁 + 本轮新增；已转为永久封禁的 IP 不再放进临时规则
+    perm_set = set(perm_ips) if perm_ok else set()
+    temp_ips = [ip for ip in active_temp if ip not in perm_set]
+    temp_ips.extend(ip for ip, *_ in new_temp)
+    temp_ok = fw_upsert_pool_rule(RULE_TEMP_POOL_NAME, temp_ips)
+    if not temp_ok:
+        # 到期记录照常删除（下一轮按 bans 重建时会把它们移出规则），永久封禁按其自身结果落库；
+        # 只丢弃本轮新增的临时封禁，下一轮重新判定
+        append_log(f"错误：更新临时封禁聚合规则失败，本轮新增 {len(new_temp)} 个临时封禁未生效")
+
+    # ---- 短写事务：按防火墙结果落库 ----
+    with conn:
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
 
-    conn.commit()
-    conn.close()
+        cur.executemany(
+            "DELETE FROM bans WHERE ip=? AND kind='temp' AND expires_at <= ?",
+            [(ip, now) for ip, _ in expired]
+        )
+        for ip, _ in expired:
+            append_log(f"解封 {ip}（临时封禁到期）")
+
+        if perm_ok:
+            cur.executemany("""
+              INSERT OR REPLACE INTO bans(ip, rule_name, kind, banned_at, expires_at, reason)
+              VALUES (?,?,?,?,?,?)
+            """, [
+                (ip, RULE_POOL_NAME, "perm", now, None, f"累计>={THRESH_TOTAL}")
+                for ip, kind in perm_rows if kind != "perm"
+            ])
+
+        if temp_ok:
+            cur.executemany("""
+              INSERT OR REPLACE INTO bans(ip, rule_name, kind, banned_at, expires_at, reason)
+              VALUES (?,?,?,?,?,?)
+            """, [(ip, rule_name, "temp", banned_at, expires_at, reason)
+                  for ip, rule_name, banned_at, expires_at, reason in new_temp])
+            for ip, _, _, expires_at, reason in new_temp:
+                append_log(f"临时封禁 {ip}（{reason}），到期：{ts_to_local_str(expires_at)}")
 
 # =========================
 # 报表生成（含态势卡片 + 图表 + Top100 列表 + CSV 导出）
@@ -779,37 +1338,37 @@ def generate_report_and_exports():
     t1h = now - 3600
     from_ts = now - EVENT_RETENTION_DAYS * 86400
 
-    conn = sqlite3.connect(str(STATE_DB))
-    cur = conn.cursor()
+    cur = _get_conn().cursor()
 
     # ========= 态势卡片指标 =========
+    # COUNT(*) 恒返回整数（无匹配时为 0），sqlite3 直接给出 Python int，无需再转换
 
     cur.execute("SELECT COUNT(*) FROM events WHERE ts >= ?", (t24,))
-    hits_24h = int(cur.fetchone()[0] or 0)
+    hits_24h = cur.fetchone()[0]
 
     cur.execute("SELECT COUNT(DISTINCT ip) FROM events WHERE ts >= ?", (t24,))
-    uniq_ips_24h = int(cur.fetchone()[0] or 0)
+    uniq_ips_24h = cur.fetchone()[0]
 
     cur.execute("SELECT COUNT(DISTINCT ip) FROM events WHERE ts >= ?", (t1h,))
-    active_ips_1h = int(cur.fetchone()[0] or 0)
+    active_ips_1h = cur.fetchone()[0]
 
     cur.execute("SELECT COUNT(*) FROM stats WHERE first_seen IS NOT NULL AND first_seen >= ?", (t24,))
-    new_ips_24h = int(cur.fetchone()[0] or 0)
+    new_ips_24h = cur.fetchone()[0]
 
     cur.execute("""
       SELECT COUNT(*) FROM bans
       WHERE kind='temp' AND expires_at IS NOT NULL AND expires_at > ?
     """, (now,))
-    temp_bans_active = int(cur.fetchone()[0] or 0)
+    temp_bans_active = cur.fetchone()[0]
 
     cur.execute("SELECT COUNT(*) FROM bans WHERE kind='perm'")
-    perm_bans_total = int(cur.fetchone()[0] or 0)
+    perm_bans_total = cur.fetchone()[0]
 
     cur.execute("SELECT COUNT(*) FROM drops WHERE ts >= ?", (t24,))
-    drops_24h = int(cur.fetchone()[0] or 0)
+    drops_24h = cur.fetchone()[0]
 
     cur.execute("SELECT COUNT(DISTINCT ip) FROM drops WHERE ts >= ?", (t24,))
-    drops_ips_24h = int(cur.fetchone()[0] or 0)
+    drops_ips_24h = cur.fetchone()[0]
 
     # ========= 近24小时攻击 IP Top100（带封禁状态） =========
     cur.execute(f"""
@@ -819,7 +1378,7 @@ def generate_report_and_exports():
              MAX(e.ts) AS last_ts,
              b.kind,
              b.expires_at
-      FROM events e
+      FROM events e INDEXED BY idx_events_ts_ip
       LEFT JOIN bans b ON b.ip = e.ip
       WHERE e.ts >= ?
       GROUP BY e.ip, b.kind, b.expires_at
@@ -834,7 +1393,7 @@ def generate_report_and_exports():
              COUNT(*) AS drops_24h,
              MIN(d.ts) AS first_ts,
              MAX(d.ts) AS last_ts
-      FROM drops d
+      FROM drops d INDEXED BY idx_drops_ts_ip
       WHERE d.ts >= ?
       GROUP BY d.ip
       ORDER BY drops_24h DESC, last_ts DESC
@@ -852,17 +1411,20 @@ def generate_report_and_exports():
     bans_200 = cur.fetchall()
 
     # ========= 每日命中趋势（近 EVENT_RETENTION_DAYS 天） =========
+    # 直接汇总小时桶：日期换算只对每个小时桶做一次（最多 24*天数 行），而不是逐条事件
+    # 按本地时区分日（不用 hour_ts/86400：那是 UTC 日界，东八区会把 0~8 点算进前一天）
+    # 注意：小时桶按 UTC 整点对齐，本地时区为整小时偏移时日界精确；
+    #       非整小时偏移（如 +05:30 / +09:30）时，跨本地零点的那个小时桶会整体计入其起点所在日期
+    # 起点 from_ts 向上取整到整点：不把保留期之前的那部分小时桶算进来（最早一天少算不足一小时）
     cur.execute("""
-      SELECT date(datetime(ts,'unixepoch','localtime')) AS day, COUNT(*) AS hits
-      FROM events
-      WHERE ts >= ?
+      SELECT date(hour_ts, 'unixepoch', 'localtime') AS day, SUM(hits) AS hits
+      FROM events_bucket
+      WHERE hour_ts >= ?
       GROUP BY day
       ORDER BY day ASC
-    """, (from_ts,))
+    """, (from_ts + (-from_ts) % 3600,))
     daily = cur.fetchall()
 
-    conn.close()
-
     # ========= 导出 CSV =========
 
     def fmt_ts(x):
@@ -913,45 +1475,51 @@ def generate_report_and_exports():
     )
 
     # ========= 可选图表（每日趋势） =========
-    plt = None
-    try:
-        import matplotlib.pyplot as plt  # type: ignore
-    except Exception:
+    # 图表只取决于 daily：数据摘要与上次相同且图片还在则跳过（连 matplotlib 都不导入）
+    chart_digest = hashlib.blake2b(repr(daily).encode("utf-8"), digest_size=8).hexdigest()
+    if chart_digest != get_meta("chart_digest", "") or not CHART_DAILY.exists():
         plt = None
-
-    if plt:
-        use_cn = _pick_cjk_font_if_possible()
         try:
-            days = [r[0] for r in daily]
-            dh = [r[1] for r in daily]
-            plt.figure(figsize=(10, 4))
-            plt.plot(days, dh, marker="o")
-            plt.xticks(rotation=30, ha="right")
-            plt.ylabel("命中次数（hits）" if use_cn else "Hits")
-            plt.tight_layout()
-            plt.savefig(str(CHART_DAILY), dpi=160)
-            plt.close()
+            import matplotlib
+            matplotlib.use("Agg")  # 只输出 PNG，不初始化 GUI 后端
+            import matplotlib.pyplot as plt  # type: ignore
         except Exception:
-            pass
+            plt = None
+
+        if plt:
+            use_cn = _pick_cjk_font_if_possible()
+            try:
+                days = [r[0] for r in daily]
+                dh = [r[1] for r in daily]
+                plt.figure(figsize=(10, 4))
+                plt.plot(days, dh, marker="o")
+                plt.xticks(rotation=30, ha="right")
+                plt.ylabel("命中次数（hits）" if use_cn else "Hits")
+                plt.tight_layout()
+                plt.savefig(str(CHART_DAILY), dpi=160)
+                plt.close()
+                set_meta("chart_digest", chart_digest)
+            except Exception:
+                pass
 
     # ========= HTML 表格渲染 =========
 
-    bans_rows_html = "\n".join(
+    bans_rows_html = "\n".join([
         f"<tr><td>{ip}</td><td>{kind}</td><td>{reason}</td><td>{fmt_ts(bat) or '-'}</td>"
         f"<td>{(fmt_ts(exp) if exp is not None else ('永久' if kind=='perm' else '-'))}</td></tr>"
         for ip, kind, reason, bat, exp in bans_200
-    )
+    ])
 
-    attacks_rows_html = "\n".join(
+    attacks_rows_html = "\n".join([
         f"<tr><td>{ip}</td><td>{hits}</td><td>{fmt_ts(first_ts) or '-'}</td><td>{fmt_ts(last_ts) or '-'}</td>"
         f"<td>{(kind or '-')}</td><td>{(fmt_exp(kind, expires_at) or '-')}</td></tr>"
         for ip, hits, first_ts, last_ts, kind, expires_at in attacks_24h_top
-    )
+    ])
 
-    drops_rows_html = "\n".join(
+    drops_rows_html = "\n".join([
         f"<tr><td>{ip}</td><td>{cnt}</td><td>{fmt_ts(first_ts) or '-'}</td><td>{fmt_ts(last_ts) or '-'}</td></tr>"
         for ip, cnt, first_ts, last_ts in drops_24h_top
-    )
+    ])
 
     # ========= HTML 输出 =========
     html = f"""<!doctype html>
@@ -1090,20 +1658,31 @@ img{{max-width:100%;border-radius:10px;border:1px solid var(--border);background
 # =========================
 
 def run_once():
-    """执行一轮：快照 -> 导入 -> 封禁 -> DROP 导入 -> 报表 + CSV"""
+    """执行一轮：读取火绒 DB（必要时快照） -> 导入 -> 封禁 -> DROP 导入 -> 报表 + CSV"""
     ensure_state_db()
 
     last_ts = int(get_meta("last_ts", "0"))
+    last_rowid = int(get_meta("last_rowid", "0"))
 
-    # 创建火绒 DB 快照
+    # 增量读取新事件：优先只读直连火绒 DB（只触及新增行所在的页）；被锁/打不开时才落盘快照
     try:
-        snap_db = mirror_huorong_db()
-    except Exception as e:
-        append_log(f"错误：复制火绒数据库失败：{e}")
-        return
-
-    # 增量读取新事件
-    events, max_ts = read_new_events_from_snapshot(snap_db, last_ts)
+        conn = open_huorong_live_db()
+        try:
+            events, max_ts, max_rowid = read_new_events(conn, last_ts, last_rowid)
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        append_log(f"直连火绒数据库读取失败，改用快照：{e}")
+        try:
+            snap_db = mirror_huorong_db()
+        except Exception as e:
+            append_log(f"错误：复制火绒数据库失败：{e}")
+            return
+        conn = sqlite3.connect(str(snap_db))
+        try:
+            events, max_ts, max_rowid = read_new_events(conn, last_ts, last_rowid)
+        finally:
+            conn.close()
 
     if events:
         update_state_with_events(events)
@@ -1111,6 +1690,8 @@ def run_once():
         append_log(f"已导入 {len(events)} 条新事件，最大 ts={max_ts}")
     else:
         append_log("本轮未导入新事件（0）")
+    if max_rowid is not None and max_rowid != last_rowid:
+        set_meta("last_rowid", str(max_rowid))
 
     # 封禁/解封
     decide_and_apply_bans()
@@ -1147,8 +1728,11 @@ def main():
             elapsed = time.time() - start
             sleep_s = max(5, POLL_SECONDS - int(elapsed))
             append_log(f"等待下一轮：{sleep_s}s")
+            flush_log()
             time.sleep(sleep_s)
     finally:
+        close_state_db()
+        close_log()
         release_lock()
 
 if __name__ == "__main__":